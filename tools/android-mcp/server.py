@@ -7,18 +7,37 @@ Two-layer architecture:
 - Layer 2: Debug HTTP server inside app for high-level commands (OpenChat, SendMessage, etc.)
 """
 
+import asyncio
+import collections
+import functools
+import http.client
+import io
 import json
 import os
 import re
+import select
+import shlex
+import struct
 import subprocess
+import tempfile
+import threading
 import time
-import xml.etree.ElementTree as ET
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
-from urllib.request import urlopen, Request
-from urllib.error import URLError
-
+from xml.parsers import expat
+
+try:
+    from lxml import etree as ET  # C parser, much faster on large UI dumps
+except ImportError:
+    import xml.etree.ElementTree as ET
+try:
+    import uvloop  # faster event loop for the stdio transport, if installed
+except ImportError:
+    uvloop = None
+import anyio
 from PIL import Image
 from mcp.server.fastmcp import FastMCP
 
@@ -35,6 +54,7 @@ DEBUG_PORT = int(os.environ.get("DEBUG_SERVER_PORT", _CFG.get("debug_server_port
 SCREENSHOT_DIR = _CFG.get("screenshot_dir", "/tmp/android-screenshots")
 DUMP_RETRIES = _CFG.get("uiautomator_dump_retries", 3)
 DUMP_RETRY_DELAY = _CFG.get("uiautomator_dump_retry_delay", 1.0)
+UI_TREE_CACHE_TTL = _CFG.get("ui_tree_cache_ttl", 0.5)
 
 Path(SCREENSHOT_DIR).mkdir(parents=True, exist_ok=True)
 
@@ -42,57 +62,319 @@ Path(SCREENSHOT_DIR).mkdir(parents=True, exist_ok=True)
 # ADB helpers
 # ---------------------------------------------------------------------------
 
-def _adb(args: str, timeout: int = 30) -> str:
-    """Run adb command, return stdout."""
-    cmd = f"{ADB_PATH} -s {DEVICE} {args}"
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=timeout)
+class _AdbShell:
+    """Long-lived `adb shell` session so each command costs a pipe write, not a fork.
+
+    Commands are terminated with an `echo __END__:$?` sentinel; output is read
+    until the sentinel appears. The session is respawned if adb exits.
+    """
+
+    _END_RE = re.compile(rb'__END__:(\d+)\r?\n')
+
+    def __init__(self):
+        self.proc: Optional[subprocess.Popen] = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        self.proc = subprocess.Popen(
+            [ADB_PATH, "-s", DEVICE, "shell"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            bufsize=0,
+        )
+
+    def _kill(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def _exchange(self, cmd: str, timeout: float) -> tuple[int, str]:
+        if self.proc is None or self.proc.poll() is not None:
+            self._start()
+        self.proc.stdin.write(f"{cmd}; echo __END__:$?\n".encode())
+        fd = self.proc.stdout.fileno()
+        deadline = time.monotonic() + timeout
+        buf = bytearray()
+        while True:
+            m = self._END_RE.search(buf)
+            if m:
+                return int(m.group(1)), buf[:m.start()].decode("utf-8", "replace")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                # Keep whatever adb printed on the way out ("device not found", ...)
+                out = buf.decode("utf-8", "replace").strip()
+                raise BrokenPipeError(f"adb shell exited: {out}" if out else "adb shell exited")
+            buf += chunk
+
+    def run(self, cmd: str, timeout: float = 30) -> tuple[int, str]:
+        """Run a device-side shell command, return (exit status, combined output)."""
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    return self._exchange(cmd, timeout)
+                except BaseException as e:
+                    # Session state is unknown after a failure (a timed-out command
+                    # may still write its output later); start fresh next time
+                    self._kill()
+                    # adb went away (device reconnect, server restart) -- respawn once
+                    if attempt == 0 and isinstance(e, BrokenPipeError):
+                        continue
+                    raise
+
+
+_shell = _AdbShell()
+
+
+def _adb_shell(cmd: str, timeout: int = 30) -> str:
+    """Run a device-side shell command on the persistent session, return output."""
+    status, out = _shell.run(cmd, timeout=timeout)
+    if status != 0 and "Error" in out:
+        raise RuntimeError(f"adb error: {out.strip()}")
+    return out.strip()
+
+
+def _adb(args: list[str] | str, timeout: int = 30) -> str:
+    """Run adb command, return stdout.
+
+    `shell ...` commands go through the persistent shell session: a str is handed
+    to the device shell as-is, a list is taken as literal argv and quoted for it.
+    Other verbs (forward, install, ...) exec a fresh adb process, no host shell.
+    """
+    if isinstance(args, str):
+        if args.startswith("shell "):
+            return _adb_shell(args[len("shell "):], timeout=timeout)
+        args = shlex.split(args)
+    elif args[0] == "shell":
+        return _adb_shell(shlex.join(args[1:]), timeout=timeout)
+    result = subprocess.run([ADB_PATH, "-s", DEVICE, *args],
+                            capture_output=True, text=True, timeout=timeout)
     if result.returncode != 0 and "Error" in result.stderr:
         raise RuntimeError(f"adb error: {result.stderr.strip()}")
     return result.stdout.strip()
 
 
-def _adb_raw(args: str, timeout: int = 30) -> bytes:
+def _adb_raw(args: list[str] | str, timeout: int = 30) -> bytes:
     """Run adb command, return raw bytes."""
-    cmd = f"{ADB_PATH} -s {DEVICE} {args}"
-    return subprocess.run(cmd, shell=True, capture_output=True, timeout=timeout).stdout
+    if isinstance(args, str):
+        args = shlex.split(args)
+    return subprocess.run([ADB_PATH, "-s", DEVICE, *args], capture_output=True, timeout=timeout).stdout
+
+
+def _adb_tail(args: list[str], lines: int, timeout: int = 10) -> str:
+    """Run adb command, return the last `lines` lines of its stdout.
+
+    Only that tail is kept in memory (as raw bytes) and decoded once at the end.
+    Raises like _adb on timeout or an adb error.
+    """
+    argv = [ADB_PATH, "-s", DEVICE, *args]
+    timed_out = threading.Event()
+    # stderr goes to a file so a chatty adb can't block on a full pipe
+    with tempfile.TemporaryFile() as err, \
+            subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=err) as proc:
+
+        def _kill():
+            if proc.poll() is None:
+                timed_out.set()
+                proc.kill()
+
+        timer = threading.Timer(timeout, _kill)
+        timer.start()
+        try:
+            tail = collections.deque(proc.stdout, maxlen=max(lines, 1))
+            proc.wait()
+        finally:
+            timer.cancel()
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(argv, timeout)
+        err.seek(0)
+        stderr = err.read().decode("utf-8", "replace")
+    if proc.returncode != 0 and "Error" in stderr:
+        raise RuntimeError(f"adb error: {stderr.strip()}")
+    return b"".join(tail).decode("utf-8", "replace").strip()
+
 
 # ---------------------------------------------------------------------------
 # UIAutomator XML parsing
 # ---------------------------------------------------------------------------
 
+_BOUNDS_RE = re.compile(r'\[(\d+),(\d+)\]\[(\d+),(\d+)\]')
+
+
 def _parse_bounds(bounds_str: str) -> tuple[int, int, int, int]:
     """Parse '[x1,y1][x2,y2]' into (x1, y1, x2, y2)."""
-    m = re.match(r'\[(\d+),(\d+)\]\[(\d+),(\d+)\]', bounds_str)
+    m = _BOUNDS_RE.match(bounds_str)
     if not m:
         raise ValueError(f"Invalid bounds: {bounds_str}")
-    return int(m.group(1)), int(m.group(2)), int(m.group(3)), int(m.group(4))
+    x1, y1, x2, y2 = m.groups()
+    return int(x1), int(y1), int(x2), int(y2)
 
 
-def _center_of(bounds_str: str) -> tuple[int, int]:
-    """Get center point of bounds."""
-    x1, y1, x2, y2 = _parse_bounds(bounds_str)
-    return (x1 + x2) // 2, (y1 + y2) // 2
+class _UiIndex:
+    """Flat struct-of-arrays view of a UI dump for find-and-tap lookups.
 
+    Filled by a single expat (SAX) pass, one slot per element and no Element
+    objects. Bounds are parsed to ints at ingest; -1 marks a node without bounds.
+    """
 
-def _dump_ui_tree() -> Optional[ET.Element]:
-    """Dump UIAutomator hierarchy with retries for idle-state failures."""
-    for attempt in range(DUMP_RETRIES):
+    def __init__(self, raw: bytes):
+        self.classes: list[str] = []
+        self.res_ids: list[str] = []
+        self.texts: list[str] = []
+        self.descs: list[str] = []
+        self.x1, self.y1 = array("i"), array("i")
+        self.x2, self.y2 = array("i"), array("i")
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = self._add
+        parser.Parse(raw, True)
+
+    def _add(self, tag: str, attrs: dict[str, str]):
+        self.classes.append(attrs.get("class", ""))
+        self.res_ids.append(attrs.get("resource-id", ""))
+        self.texts.append(attrs.get("text", ""))
+        self.descs.append(attrs.get("content-desc", ""))
         try:
-            xml_str = _adb("shell uiautomator dump /dev/tty", timeout=10)
-            # Remove the "UI hierarchy dumped to:" prefix line
-            xml_str = re.sub(r'^UI hierarch?y dumped to:.*\n?', '', xml_str)
-            if not xml_str.strip().startswith('<?xml') and not xml_str.strip().startswith('<hierarchy'):
-                # Try extracting XML portion
-                idx = xml_str.find('<hierarchy')
-                if idx == -1:
-                    idx = xml_str.find('<?xml')
-                if idx >= 0:
-                    xml_str = xml_str[idx:]
-            return ET.fromstring(xml_str)
-        except Exception:
-            if attempt < DUMP_RETRIES - 1:
-                time.sleep(DUMP_RETRY_DELAY * (attempt + 1))
-    return None
+            x1, y1, x2, y2 = _parse_bounds(attrs.get("bounds", ""))
+        except ValueError:
+            x1 = y1 = x2 = y2 = -1
+        self.x1.append(x1)
+        self.y1.append(y1)
+        self.x2.append(x2)
+        self.y2.append(y2)
+
+    def find(self, resource_id: str = "", text: str = "", content_desc: str = "",
+             class_name: str = "") -> Optional[int]:
+        """Index of the first element matching all given (partial) criteria."""
+        text = text.lower()
+        content_desc = content_desc.lower()
+        class_name = class_name.lower()
+        for i, (rid, ntext, ndesc, ncls) in enumerate(
+                zip(self.res_ids, self.texts, self.descs, self.classes)):
+            # resource-id first: most selective, and case-sensitive so no lower()
+            if resource_id and resource_id not in rid:
+                continue
+            if text and text not in ntext.lower():
+                continue
+            if content_desc and content_desc not in ndesc.lower():
+                continue
+            if class_name and class_name not in ncls.lower():
+                continue
+            return i
+        return None
+
+    def center(self, i: int) -> Optional[tuple[int, int]]:
+        """Center point of element i, or None if it has no bounds."""
+        if self.x1[i] < 0:
+            return None
+        return (self.x1[i] + self.x2[i]) // 2, (self.y1[i] + self.y2[i]) // 2
+
+
+# Last UI dump, reused by back-to-back tool calls within UI_TREE_CACHE_TTL.
+# An entry holds the XML payload ("raw"); "root" (parsed tree) and "index"
+# (_UiIndex) are built from it on first use. _tree_lock serializes dumps
+# (uiautomator can't run two at once) and that lazy parsing. Invalidation
+# only bumps _tree_gen, without the lock, so it never waits on a dump in
+# flight; an entry counts only while its "gen" is still current.
+_tree_gen = 0
+_tree_cache: Optional[dict] = None
+_tree_lock = threading.RLock()
+
+
+def _invalidate_ui_tree():
+    """Drop the cached UI tree after any input that may change the screen."""
+    global _tree_gen
+    _tree_gen += 1
+
+
+def _ui_tree_entry(force: bool = False) -> Optional[dict]:
+    """Return the current dump entry, dumping again if it is missing, stale or force is set.
+
+    Retries for idle-state failures. A dump that raced an invalidation is
+    returned to its caller but not cached.
+    """
+    global _tree_cache
+    with _tree_lock:
+        entry = _tree_cache
+        if (not force and entry is not None and entry["gen"] == _tree_gen
+                and time.monotonic() - entry["ts"] < UI_TREE_CACHE_TTL):
+            return entry
+        for attempt in range(DUMP_RETRIES):
+            gen = _tree_gen
+            try:
+                raw = _adb_raw("exec-out uiautomator dump /dev/tty", timeout=10)
+                # Skip the "UI hierarchy dumped to:" status line, which some devices
+                # print before the XML and some after; parse bytes directly
+                idx = raw.find(b'<')
+                end = raw.rfind(b'</hierarchy>')
+                if idx < 0 or end < 0:
+                    raise ValueError("No complete XML in uiautomator output")
+                entry = {"gen": gen, "ts": time.monotonic(),
+                         "raw": raw[idx:end + len(b'</hierarchy>')],
+                         "root": None, "index": None}
+                if gen == _tree_gen:
+                    _tree_cache = entry
+                return entry
+            except Exception:
+                if attempt < DUMP_RETRIES - 1:
+                    time.sleep(DUMP_RETRY_DELAY * (attempt + 1))
+        return None
+
+
+def _parsed_ui_tree(key: str, parse, errors, force: bool = False):
+    """Return entry[key], building it with parse(raw) on first use.
+
+    A dump that fails to parse is dropped and taken again, up to DUMP_RETRIES.
+    """
+    with _tree_lock:
+        for attempt in range(DUMP_RETRIES):
+            entry = _ui_tree_entry(force or attempt > 0)
+            if entry is None:
+                return None
+            if entry[key] is None:
+                try:
+                    entry[key] = parse(entry["raw"])
+                except errors:
+                    _invalidate_ui_tree()
+                    if attempt < DUMP_RETRIES - 1:
+                        time.sleep(DUMP_RETRY_DELAY * (attempt + 1))
+                    continue
+            return entry[key]
+        return None
+
+
+def _dump_ui_tree(force: bool = False) -> Optional[ET.Element]:
+    """Dump and fully parse the UIAutomator hierarchy (see _ui_tree_entry)."""
+    return _parsed_ui_tree("root", ET.fromstring, ET.ParseError, force)
+
+
+def _ui_index(force: bool = False) -> Optional[_UiIndex]:
+    """Dump the UIAutomator hierarchy into a _UiIndex (see _ui_tree_entry)."""
+    return _parsed_ui_tree("index", _UiIndex, expat.ExpatError, force)
+
+
+# A dump repeats the same few dozen class names and ids many times over
+@functools.lru_cache(maxsize=256)
+def _short_cls(cls: str) -> str:
+    """'android.widget.TextView' -> 'TextView'."""
+    return cls.rsplit(".", 1)[-1] if cls else "?"
+
+
+@functools.lru_cache(maxsize=256)
+def _short_rid(res_id: str) -> str:
+    """'org.telegram.messenger:id/send_button' -> 'send_button'."""
+    return res_id.rsplit("/", 1)[-1]
+
+
+# Precomputed per-line fragments for _walk_xml: indent by depth, and the state
+# tag for each (clickable, focused, disabled) bitmask
+_INDENTS = ["  " * i for i in range(32)]
+_STATE_NAMES = ("clickable", "focused", "disabled")
+_STATE_TAGS = [
+    " [" + ",".join(n for bit, n in enumerate(_STATE_NAMES) if mask >> bit & 1) + "]" if mask else ""
+    for mask in range(1 << len(_STATE_NAMES))
+]
 
 
 def _walk_xml(node: ET.Element, depth: int = 0, max_depth: int = 15) -> list[str]:
@@ -100,72 +382,120 @@ def _walk_xml(node: ET.Element, depth: int = 0, max_depth: int = 15) -> list[str
     lines = []
     if depth > max_depth:
         return lines
-
-    cls = node.get("class", "")
-    text = node.get("text", "")
-    res_id = node.get("resource-id", "")
-    desc = node.get("content-desc", "")
-    bounds = node.get("bounds", "")
-    clickable = node.get("clickable", "false")
-    enabled = node.get("enabled", "true")
-    focused = node.get("focused", "false")
-
-    # Short class name
-    short_cls = cls.rsplit(".", 1)[-1] if cls else "?"
-
-    indent = "  " * depth
-    parts = [f"{indent}[{short_cls}]"]
-    if res_id:
-        rid = res_id.rsplit("/", 1)[-1] if "/" in res_id else res_id
-        parts.append(f"@{rid}")
-    if text:
-        parts.append(f'"{text[:80]}"')
-    if desc:
-        parts.append(f'desc="{desc[:80]}"')
-
-    states = []
-    if clickable == "true":
-        states.append("clickable")
-    if focused == "true":
-        states.append("focused")
-    if enabled == "false":
-        states.append("disabled")
-    if states:
-        parts.append(f"[{','.join(states)}]")
-    if bounds:
-        parts.append(bounds)
-
-    lines.append(" ".join(parts))
-
-    for child in node:
-        lines.extend(_walk_xml(child, depth + 1, max_depth))
+    append = lines.append
+    stack = [(node, depth)]
+    while stack:
+        n, d = stack.pop()
+        a = n.attrib
+        buf = [_INDENTS[d] if d < 32 else "  " * d, "[", _short_cls(a.get("class", "")), "]"]
+        res_id = a.get("resource-id")
+        if res_id:
+            buf += (" @", _short_rid(res_id))
+        text = a.get("text")
+        if text:
+            buf += (' "', text[:80], '"')
+        desc = a.get("content-desc")
+        if desc:
+            buf += (' desc="', desc[:80], '"')
+        buf.append(_STATE_TAGS[(a.get("clickable") == "true")
+                               | (a.get("focused") == "true") << 1
+                               | (a.get("enabled") == "false") << 2])
+        bounds = a.get("bounds")
+        if bounds:
+            buf += (" ", bounds)
+        append("".join(buf))
+
+        # Push children reversed so they pop in document order; nothing below max_depth
+        if d < max_depth:
+            stack.extend((c, d + 1) for c in reversed(n))
 
     return lines
 
 
-def _find_node(root: ET.Element, resource_id: str = "", text: str = "",
-               content_desc: str = "", class_name: str = "") -> Optional[ET.Element]:
-    """Find first matching node in UI tree."""
-    for node in root.iter():
-        if resource_id:
-            nid = node.get("resource-id", "")
-            if resource_id not in nid:
-                continue
-        if text:
-            ntext = node.get("text", "")
-            if text.lower() not in ntext.lower():
-                continue
-        if content_desc:
-            ndesc = node.get("content-desc", "")
-            if content_desc.lower() not in ndesc.lower():
-                continue
-        if class_name:
-            ncls = node.get("class", "")
-            if class_name.lower() not in ncls.lower():
-                continue
-        return node
+# ---------------------------------------------------------------------------
+# Screenshot helpers
+# ---------------------------------------------------------------------------
+
+# Downscale target: any dimension above this is shrunk (Claude limit is 2000px)
+SCREENSHOT_MAX_DIM = 1920
+
+# `screencap` pixel formats with 4 bytes per pixel (RGBA_8888, RGBX_8888)
+_FB_FORMATS_32BPP = (1, 2)
+
+# Set once the device's raw framebuffer fails to decode; later captures go
+# straight to `screencap -p` instead of pulling the raw frame first
+_fb_raw_unsupported = False
+
+
+def _decode_framebuffer(raw: bytes) -> Optional[Image.Image]:
+    """Decode raw `screencap` output (header + pixels) without any PNG step.
+
+    The header is width, height, format as little-endian u32, plus a colorspace
+    u32 on Android 9+. Returns None for formats we don't handle.
+    """
+    if len(raw) < 12:
+        return None
+    w, h, fmt = struct.unpack_from("<III", raw)
+    header = len(raw) - w * h * 4
+    if fmt not in _FB_FORMATS_32BPP or header not in (12, 16):
+        return None
+    # Alpha is meaningless for a screenshot; unpacking as RGBX drops it
+    return Image.frombytes("RGB", (w, h), memoryview(raw)[header:], "raw", "RGBX")
+
+
+def _downscale(img: Image.Image) -> Image.Image:
+    """Shrink img to fit SCREENSHOT_MAX_DIM, keeping aspect ratio."""
+    w, h = img.size
+    if w <= SCREENSHOT_MAX_DIM and h <= SCREENSHOT_MAX_DIM:
+        return img
+    scale = SCREENSHOT_MAX_DIM / max(w, h)
+    return img.resize((int(w * scale), int(h * scale)), Image.Resampling.BILINEAR)
+
+
+def _capture_screenshot(filepath: str) -> Optional[str]:
+    """Capture the screen into filepath as PNG. Returns an error message on failure."""
+    global _fb_raw_unsupported
+    img = None
+    if not _fb_raw_unsupported:
+        # Capture the raw framebuffer: no PNG encode on the device, no decode here
+        raw = _adb_raw("exec-out screencap", timeout=15)
+        if not raw:
+            return "ERROR: Screenshot failed -- empty data returned."
+        try:
+            img = _decode_framebuffer(raw)
+        except Exception:
+            img = None
+        if img is None:
+            _fb_raw_unsupported = True
+    if img is not None:
+        _downscale(img).save(filepath, "PNG", compress_level=1)
+    else:
+        # Unhandled pixel format -- fall back to a device-encoded PNG
+        raw = _adb_raw("exec-out screencap -p", timeout=15)
+        if not raw or len(raw) < 100:
+            return "ERROR: Screenshot failed -- empty data returned."
+
+        # Size comes from the PNG IHDR chunk (right after the 8-byte signature), so
+        # screenshots already within the limit are saved without decoding.
+        if raw[:8] == b"\x89PNG\r\n\x1a\n" and raw[12:16] == b"IHDR":
+            w = int.from_bytes(raw[16:20], "big")
+            h = int.from_bytes(raw[20:24], "big")
+            needs_resize = w > SCREENSHOT_MAX_DIM or h > SCREENSHOT_MAX_DIM
+        else:
+            needs_resize = True  # Not a plain PNG; let PIL sort it out
+        if needs_resize:
+            try:
+                _downscale(Image.open(io.BytesIO(raw))).save(filepath, "PNG", compress_level=1)
+                raw = None
+            except Exception:
+                pass  # If resize fails, save original screenshot
+
+        if raw is not None:
+            with open(filepath, "wb") as f:
+                f.write(raw)
     return None
 
+
 # ---------------------------------------------------------------------------
 # Debug HTTP server helper (Layer 2)
 # ---------------------------------------------------------------------------
@@ -173,32 +503,97 @@ def _find_node(root: ET.Element, resource_id: str = "", text: str = "",
 _port_forwarded = False
 
 
-def _ensure_port_forward():
-    """Set up adb port forwarding for debug HTTP server."""
+def _ensure_port_forward(force: bool = False):
+    """Set up adb port forwarding for debug HTTP server.
+
+    A forward already registered with adb (e.g. by a previous server process) is
+    reused. force re-creates it after the forward was lost.
+    """
     global _port_forwarded
-    if _port_forwarded:
+    if _port_forwarded and not force:
         return
     try:
-        _adb(f"forward tcp:{DEBUG_PORT} tcp:{DEBUG_PORT}")
+        spec = f"tcp:{DEBUG_PORT} tcp:{DEBUG_PORT}"
+        if not force and f"{DEVICE} {spec}" in _adb("forward --list").splitlines():
+            _port_forwarded = True
+            return
+        _adb(f"forward {spec}")
         _port_forwarded = True
     except Exception as e:
         raise RuntimeError(f"Failed to set up port forwarding: {e}")
 
 
+# Keep-alive connection to the debug server, shared by all Layer 2 calls
+_http = http.client.HTTPConnection("localhost", DEBUG_PORT, timeout=10)
+_http_lock = threading.Lock()
+
+
+def _http_send(method: str, path: str, body: bytes | None, timeout: int):
+    """Send one request on the shared connection, reconnecting if it went stale."""
+    if _http.sock is not None:
+        # An idle keep-alive socket that polls readable was closed by the server
+        # (EOF); drop it now rather than send a request into it
+        if select.select([_http.sock], [], [], 0)[0]:
+            _http.close()
+        else:
+            _http.sock.settimeout(timeout)
+    _http.timeout = timeout
+    headers = {"Connection": "keep-alive"}
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+    _http.request(method, path, body=body, headers=headers)
+
+
+def _http_receive() -> bytes:
+    """Read the response to the request just sent and return its body."""
+    resp = _http.getresponse()
+    data = resp.read()
+    if resp.will_close:
+        _http.close()
+    return data
+
+
 def _debug_call(endpoint: str, params: dict | None = None, timeout: int = 10) -> dict:
     """Call debug HTTP server endpoint. Returns parsed JSON response."""
     _ensure_port_forward()
-    url = f"http://localhost:{DEBUG_PORT}/{endpoint}"
-    if params:
-        body = json.dumps(params).encode()
-        req = Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
-    else:
-        req = Request(url, method="GET")
+    # Layer 2 commands navigate the app, so any cached UI tree is stale...
+    _invalidate_ui_tree()
+    method, body = ("POST", json.dumps(params).encode()) if params else ("GET", None)
     try:
-        with urlopen(req, timeout=timeout) as resp:
-            return json.loads(resp.read().decode())
-    except URLError as e:
-        return {"ok": False, "error": f"Debug server unreachable: {e}. Is the app running with debug mode?"}
+        with _http_lock:
+            for attempt in range(2):
+                sent = False
+                try:
+                    _http_send(method, f"/{endpoint}", body, timeout)
+                    sent = True
+                    data = _http_receive()
+                    break
+                except ConnectionRefusedError as e:
+                    _http.close()
+                    if attempt == 0:
+                        # Nothing listening on the host port: adb dropped the forward
+                        # (adb server restart, device reconnect). Re-create it and retry once.
+                        _ensure_port_forward(force=True)
+                        continue
+                    error = e
+                except (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                        ConnectionResetError, BrokenPipeError) as e:
+                    # Server dropped the socket. Retry once only if that can't repeat
+                    # a side effect: a GET, or a request that never went out. A POST
+                    # (sendMessage, startCall, ...) may already have been handled.
+                    _http.close()
+                    if attempt == 0 and (method == "GET" or not sent):
+                        continue
+                    error = e
+                except (OSError, http.client.HTTPException) as e:
+                    _http.close()
+                    error = e
+                return {"ok": False, "error": f"Debug server unreachable: {error}. Is the app running with debug mode?"}
+    finally:
+        # ...and again once it has been handled, dropping any dump taken meanwhile
+        _invalidate_ui_tree()
+    try:
+        return json.loads(data.decode())
     except json.JSONDecodeError:
         return {"ok": False, "error": "Invalid JSON response from debug server"}
 
@@ -222,7 +617,7 @@ mcp = FastMCP(
 # ---------------------------------------------------------------------------
 
 @mcp.tool()
-def android_snapshot(max_depth: int = 15) -> str:
+async def android_snapshot(max_depth: int = 15) -> str:
     """Get the UI accessibility tree of the Android screen.
 
     Returns structured text tree showing all visible widgets with their class,
@@ -234,15 +629,15 @@ def android_snapshot(max_depth: int = 15) -> str:
     Args:
         max_depth: Maximum tree depth (default 15).
     """
-    root = _dump_ui_tree()
+    root = await asyncio.to_thread(_dump_ui_tree)
     if root is None:
         return "ERROR: Failed to dump UI tree after retries. App may have animations blocking idle state."
-    lines = _walk_xml(root, max_depth=max_depth)
+    lines = await asyncio.to_thread(_walk_xml, root, max_depth=max_depth)
     return "\n".join(lines) if lines else "UI tree is empty."
 
 
 @mcp.tool()
-def android_click(resource_id: str = "", text: str = "", content_desc: str = "") -> str:
+async def android_click(resource_id: str = "", text: str = "", content_desc: str = "") -> str:
     """Click a UI element by resource-id, text, or content-desc.
 
     Finds the element in UIAutomator tree and taps its center coordinates.
@@ -256,27 +651,28 @@ def android_click(resource_id: str = "", text: str = "", content_desc: str = "")
     if not resource_id and not text and not content_desc:
         return "ERROR: Provide at least one of resource_id, text, or content_desc."
 
-    root = _dump_ui_tree()
-    if root is None:
+    index = await asyncio.to_thread(_ui_index)
+    if index is None:
         return "ERROR: Failed to dump UI tree."
 
-    node = _find_node(root, resource_id=resource_id, text=text, content_desc=content_desc)
-    if node is None:
+    i = index.find(resource_id=resource_id, text=text, content_desc=content_desc)
+    if i is None:
         return f"ERROR: Element not found (resource_id='{resource_id}', text='{text}', content_desc='{content_desc}'). Use android_snapshot to see available elements."
 
-    bounds = node.get("bounds", "")
-    if not bounds:
+    center = index.center(i)
+    if center is None:
         return "ERROR: Element has no bounds."
 
-    x, y = _center_of(bounds)
-    _adb(f"shell input tap {x} {y}")
+    x, y = center
+    await asyncio.to_thread(_adb, f"shell input tap {x} {y}")
+    _invalidate_ui_tree()
 
-    desc = node.get("text") or node.get("content-desc") or node.get("resource-id", "?")
-    return f"Tapped [{node.get('class', '?').rsplit('.', 1)[-1]}] '{desc}' at ({x}, {y})."
+    desc = index.texts[i] or index.descs[i] or index.res_ids[i] or "?"
+    return f"Tapped [{_short_cls(index.classes[i])}] '{desc}' at ({x}, {y})."
 
 
 @mcp.tool()
-def android_type(text: str, resource_id: str = "", element_text: str = "") -> str:
+async def android_type(text: str, resource_id: str = "", element_text: str = "") -> str:
     """Type text into a field. Optionally find and tap the field first.
 
     If resource_id or element_text is provided, finds the element and taps it first.
@@ -288,61 +684,55 @@ def android_type(text: str, resource_id: str = "", element_text: str = "") -> st
         element_text: Optional existing text to find the field by.
     """
     if resource_id or element_text:
-        root = _dump_ui_tree()
-        if root:
-            node = _find_node(root, resource_id=resource_id, text=element_text)
-            if node:
-                bounds = node.get("bounds", "")
-                if bounds:
-                    x, y = _center_of(bounds)
-                    _adb(f"shell input tap {x} {y}")
-                    time.sleep(0.3)
-
-    # Select all + delete to clear
-    _adb("shell input keyevent KEYCODE_MOVE_HOME")
-    _adb("shell input keyevent --longpress KEYCODE_SHIFT_LEFT KEYCODE_MOVE_END")
-    _adb("shell input keyevent KEYCODE_DEL")
-    time.sleep(0.1)
-
-    # Type text (escape special chars for shell)
-    escaped = (text
-               .replace("\\", "\\\\")
-               .replace("\"", "\\\"")
-               .replace(" ", "%s")
-               .replace("&", "\\&")
-               .replace("<", "\\<")
-               .replace(">", "\\>")
-               .replace("'", "\\'"))
-    _adb(f'shell input text "{escaped}"')
+        index = await asyncio.to_thread(_ui_index)
+        if index is not None:
+            i = index.find(resource_id=resource_id, text=element_text)
+            center = index.center(i) if i is not None else None
+            if center is not None:
+                x, y = center
+                await asyncio.to_thread(_adb, f"shell input tap {x} {y}")
+                _invalidate_ui_tree()
+                await asyncio.sleep(0.3)
+
+    # Select all + delete to clear, then type (spaces as %s for `input text`,
+    # quoted for the device shell) -- one shell round-trip for the whole chain
+    await asyncio.to_thread(_adb, "shell input keyevent KEYCODE_MOVE_HOME"
+                            "; input keyevent --longpress KEYCODE_SHIFT_LEFT KEYCODE_MOVE_END"
+                            "; input keyevent KEYCODE_DEL"
+                            "; sleep 0.1"
+                            f"; input text {shlex.quote(text.replace(' ', '%s'))}")
+    _invalidate_ui_tree()
     return f"Typed '{text}'."
 
 
 @mcp.tool()
-def android_tap(x: int, y: int) -> str:
+async def android_tap(x: int, y: int) -> str:
     """Tap at exact screen coordinates.
 
     Args:
         x: X coordinate (pixels from left).
         y: Y coordinate (pixels from top).
     """
-    _adb(f"shell input tap {x} {y}")
+    await asyncio.to_thread(_adb, f"shell input tap {x} {y}")
+    _invalidate_ui_tree()
     return f"Tapped at ({x}, {y})."
 
 
 @mcp.tool()
-def android_swipe(x1: int, y1: int, x2: int, y2: int, duration_ms: int = 300) -> str:
+async def android_swipe(x1: int, y1: int, x2: int, y2: int, duration_ms: int = 300) -> str:
     """Swipe from one point to another.
 
     Args:
         x1: Start X. y1: Start Y. x2: End X. y2: End Y.
         duration_ms: Swipe duration in milliseconds (default 300).
     """
-    _adb(f"shell input swipe {x1} {y1} {x2} {y2} {duration_ms}")
+    await asyncio.to_thread(_adb, f"shell input swipe {x1} {y1} {x2} {y2} {duration_ms}")
+    _invalidate_ui_tree()
     return f"Swiped from ({x1},{y1}) to ({x2},{y2}) in {duration_ms}ms."
 
 
 @mcp.tool()
-def android_press_key(key: str) -> str:
+async def android_press_key(key: str) -> str:
     """Press a key on the Android device.
 
     Args:
@@ -350,12 +740,13 @@ def android_press_key(key: str) -> str:
              DPAD_UP, DPAD_DOWN, DPAD_LEFT, DPAD_RIGHT, or any KEYCODE_* name.
     """
     keycode = key if key.startswith("KEYCODE_") else f"KEYCODE_{key.upper()}"
-    _adb(f"shell input keyevent {keycode}")
+    await asyncio.to_thread(_adb, f"shell input keyevent {keycode}")
+    _invalidate_ui_tree()
     return f"Key '{key}' pressed."
 
 
 @mcp.tool()
-def android_screenshot(filename: str = "") -> str:
+async def android_screenshot(filename: str = "") -> str:
     """Take a screenshot of the Android device screen.
 
     Args:
@@ -375,50 +766,30 @@ def android_screenshot(filename: str = "") -> str:
 
     Path(filepath).parent.mkdir(parents=True, exist_ok=True)
 
-    # Capture screenshot via adb
-    raw = _adb_raw("exec-out screencap -p", timeout=15)
-    if not raw or len(raw) < 100:
-        return "ERROR: Screenshot failed -- empty data returned."
-
-    with open(filepath, "wb") as f:
-        f.write(raw)
-
-    # Downscale if any dimension exceeds 1920px (Claude limit is 2000px)
-    MAX_DIM = 1920
-    try:
-        img = Image.open(filepath)
-        w, h = img.size
-        if w > MAX_DIM or h > MAX_DIM:
-            scale = MAX_DIM / max(w, h)
-            new_w, new_h = int(w * scale), int(h * scale)
-            img = img.resize((new_w, new_h), Image.LANCZOS)
-            img.save(filepath, "PNG", optimize=True)
-    except Exception:
-        pass  # If resize fails, return original screenshot
+    error = await asyncio.to_thread(_capture_screenshot, filepath)
+    if error:
+        return error
 
     size = os.path.getsize(filepath)
     return f"Screenshot saved: {filepath} ({size} bytes)"
 
 
 @mcp.tool()
-def android_logcat(tag: str = "", lines: int = 50, level: str = "V") -> str:
-    """Read Android logcat output.
+async def android_logcat(tag: str = "", lines: int = 50, level: str = "V") -> str:
+    """Read Android logcat output from the main and crash buffers.
 
     Args:
         tag: Filter by tag (e.g. "DebugTestServer", "Telegram"). Empty = all.
         lines: Number of recent lines (default 50).
         level: Minimum level: V(erbose), D(ebug), I(nfo), W(arn), E(rror). Default V.
     """
-    cmd = f"shell logcat -d -t {lines}"
-    if tag:
-        cmd += f" -s {tag}:{level}"
-    else:
-        cmd += f" *:{level}"
-    return _adb(cmd, timeout=10)
+    args = ["logcat", "-d", "-t", str(lines), "-b", "main", "-b", "crash"]
+    args += ["-s", f"{tag}:{level}"] if tag else [f"*:{level}"]
+    return await asyncio.to_thread(_adb_tail, args, lines)
 
 
 @mcp.tool()
-def android_app_install(apk_path: str) -> str:
+async def android_app_install(apk_path: str) -> str:
     """Install an APK on the device.
 
     Args:
@@ -426,11 +797,11 @@ def android_app_install(apk_path: str) -> str:
     """
     if not os.path.exists(apk_path):
         return f"ERROR: APK not found: {apk_path}"
-    return _adb(f"install -r -d {apk_path}", timeout=120)
+    return await asyncio.to_thread(_adb, ["install", "-r", "-d", apk_path], timeout=120)
 
 
 @mcp.tool()
-def android_app_launch(package: str, activity: str = "") -> str:
+async def android_app_launch(package: str, activity: str = "") -> str:
     """Launch an Android app by package name.
 
     Args:
@@ -438,20 +809,32 @@ def android_app_launch(package: str, activity: str = "") -> str:
         activity: Optional activity to launch. If empty, launches default.
     """
     if activity:
-        return _adb(f"shell am start -n {package}/{activity}")
+        cmd = f"shell am start -n {package}/{activity}"
     else:
-        return _adb(f"shell monkey -p {package} -c android.intent.category.LAUNCHER 1")
+        cmd = f"shell monkey -p {package} -c android.intent.category.LAUNCHER 1"
+    try:
+        return await asyncio.to_thread(_adb, cmd)
+    finally:
+        # Drops any dump taken while the launch was in flight
+        _invalidate_ui_tree()
 
 
 @mcp.tool()
-def android_device_info() -> str:
+async def android_device_info() -> str:
     """Get connected device information."""
     try:
-        model = _adb("shell getprop ro.product.model")
-        sdk = _adb("shell getprop ro.build.version.sdk")
-        abi = _adb("shell getprop ro.product.cpu.abi")
-        size = _adb("shell wm size").replace("Physical size: ", "")
-        density = _adb("shell wm density").replace("Physical density: ", "")
+        out = await asyncio.to_thread(_adb, "shell echo ---MODEL---; getprop ro.product.model"
+                                      "; echo ---SDK---; getprop ro.build.version.sdk"
+                                      "; echo ---ABI---; getprop ro.product.cpu.abi"
+                                      "; echo ---SIZE---; wm size"
+                                      "; echo ---DEN---; wm density")
+        parts = re.split(r'^---(\w+)---$', out, flags=re.M)
+        fields = {k: v.strip() for k, v in zip(parts[1::2], parts[2::2])}
+        model = fields.get("MODEL", "")
+        sdk = fields.get("SDK", "")
+        abi = fields.get("ABI", "")
+        size = fields.get("SIZE", "").replace("Physical size: ", "")
+        density = fields.get("DEN", "").replace("Physical density: ", "")
         return (
             f"Model: {model}\n"
             f"SDK: {sdk}\n"
@@ -466,78 +849,78 @@ def android_device_info() -> str:
 # ---------------------------------------------------------------------------
 
 @mcp.tool()
-def android_test_open_chat(user_id: int) -> str:
+async def android_test_open_chat(user_id: int) -> str:
     """Open a chat with a user by Telegram user ID.
     Uses the debug HTTP server inside the app -- no UI clicking needed.
 
     Args:
         user_id: Telegram user ID (e.g. 136907715 for PD).
     """
-    result = _debug_call("openChat", {"userId": user_id})
+    result = await asyncio.to_thread(_debug_call, "openChat", {"userId": user_id})
     return json.dumps(result, indent=2)
 
 
 @mcp.tool()
-def android_test_send_message(user_id: int, text: str) -> str:
+async def android_test_send_message(user_id: int, text: str) -> str:
     """Send a text message to a user. Opens chat if needed.
 
     Args:
         user_id: Telegram user ID.
         text: Message text to send.
     """
-    result = _debug_call("sendMessage", {"userId": user_id, "text": text})
+    result = await asyncio.to_thread(_debug_call, "sendMessage", {"userId": user_id, "text": text})
     return json.dumps(result, indent=2)
 
 
 @mcp.tool()
-def android_test_start_call(user_id: int, video: bool = False) -> str:
+async def android_test_start_call(user_id: int, video: bool = False) -> str:
     """Start a voice or video call with a user.
 
     Args:
         user_id: Telegram user ID.
         video: If True, start video call. Default False (voice only).
     """
-    result = _debug_call("startCall", {"userId": user_id, "video": video})
+    result = await asyncio.to_thread(_debug_call, "startCall", {"userId": user_id, "video": video})
     return json.dumps(result, indent=2)
 
 
 @mcp.tool()
-def android_test_accept_call() -> str:
+async def android_test_accept_call() -> str:
     """Accept an incoming call."""
-    result = _debug_call("acceptCall")
+    result = await asyncio.to_thread(_debug_call, "acceptCall")
     return json.dumps(result, indent=2)
 
 
 @mcp.tool()
-def android_test_end_call() -> str:
+async def android_test_end_call() -> str:
     """End the current active call."""
-    result = _debug_call("endCall")
+    result = await asyncio.to_thread(_debug_call, "endCall")
     return json.dumps(result, indent=2)
 
 
 @mcp.tool()
-def android_test_get_state() -> str:
+async def android_test_get_state() -> str:
     """Get the current app state as JSON.
 
     Returns call status, active chat info, current user, etc.
     """
-    result = _debug_call("getState")
+    result = await asyncio.to_thread(_debug_call, "getState")
     return json.dumps(result, indent=2)
 
 
 @mcp.tool()
-def android_test_open_group(chat_id: int) -> str:
+async def android_test_open_group(chat_id: int) -> str:
     """Open a group chat by chat ID.
 
     Args:
         chat_id: Telegram chat ID.
     """
-    result = _debug_call("openGroup", {"chatId": chat_id})
+    result = await asyncio.to_thread(_debug_call, "openGroup", {"chatId": chat_id})
     return json.dumps(result, indent=2)
 
 
 @mcp.tool()
-def android_test_send_code(phone: str) -> str:
+async def android_test_send_code(phone: str) -> str:
     """Send verification code to a phone number for login.
     Uses the debug HTTP server to trigger auth.sendCode.
     For teamgram debug server, the magic code is '12345' if IP is whitelisted.
@@ -545,12 +928,12 @@ def android_test_send_code(phone: str) -> str:
     Args:
         phone: Phone number without '+' (e.g. "16502859925").
     """
-    result = _debug_call("sendCode", {"phone": phone}, timeout=20)
+    result = await asyncio.to_thread(_debug_call, "sendCode", {"phone": phone}, timeout=20)
     return json.dumps(result, indent=2)
 
 
 @mcp.tool()
-def android_test_sign_in(phone: str, code: str, phone_code_hash: str = "") -> str:
+async def android_test_sign_in(phone: str, code: str, phone_code_hash: str = "") -> str:
     """Sign in with verification code after calling send_code.
 
     Args:
@@ -561,21 +944,21 @@ def android_test_sign_in(phone: str, code: str, phone_code_hash: str = "") -> st
     params = {"phone": phone, "code": code}
     if phone_code_hash:
         params["phoneCodeHash"] = phone_code_hash
-    result = _debug_call("signIn", params, timeout=20)
+    result = await asyncio.to_thread(_debug_call, "signIn", params, timeout=20)
     return json.dumps(result, indent=2)
 
 
 @mcp.tool()
-def android_test_press_back() -> str:
+async def android_test_press_back() -> str:
     """Press the back button in the app (programmatic, not adb key)."""
-    result = _debug_call("pressBack")
+    result = await asyncio.to_thread(_debug_call, "pressBack")
     return json.dumps(result, indent=2)
 
 
 @mcp.tool()
-def android_test_go_home() -> str:
+async def android_test_go_home() -> str:
     """Navigate to the main dialog list (home screen)."""
-    result = _debug_call("goHome")
+    result = await asyncio.to_thread(_debug_call, "goHome")
     return json.dumps(result, indent=2)
 
 
@@ -583,5 +966,22 @@ def android_test_go_home() -> str:
 # Entry point
 # ---------------------------------------------------------------------------
 
+def _warm_up():
+    """Start the adb shell session and probe the port forward in parallel.
+
+    Runs in the background so the first tool call doesn't pay for either; errors
+    are dropped since both are redone lazily (device may not be connected yet).
+    """
+    pool = ThreadPoolExecutor(max_workers=2)
+    pool.submit(_adb_shell, "true", 10)
+    pool.submit(_ensure_port_forward)
+    pool.shutdown(wait=False)
+
+
 if __name__ == "__main__":
-    mcp.run(transport="stdio")
+    _warm_up()
+    if uvloop is not None:
+        # FastMCP serves stdio on anyio; ask it for a uvloop-backed event loop
+        anyio.run(mcp.run_stdio_async, backend_options={"use_uvloop": True})
+    else:
+        mcp.run(transport="stdio")
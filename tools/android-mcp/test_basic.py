@@ -33,16 +33,14 @@ def _center_of(bounds_str: str) -> tuple:
 
 def _dump_ui_tree() -> ET.Element:
     """Dump UIAutomator hierarchy."""
-    # Use file instead of /dev/tty for more reliable output
-    _adb("shell uiautomator dump /sdcard/Download/ui_dump.xml", timeout=10)
-    xml_str = _adb("shell cat /sdcard/Download/ui_dump.xml", timeout=10)
-    if not xml_str.strip().startswith('<?xml') and not xml_str.strip().startswith('<hierarchy'):
-        idx = xml_str.find('<hierarchy')
-        if idx == -1:
-            idx = xml_str.find('<?xml')
-        if idx >= 0:
-            xml_str = xml_str[idx:]
-    return ET.fromstring(xml_str)
+    # Stream straight back over exec-out, same as server.py (no sdcard round-trip)
+    raw = subprocess.run(
+        [ADB_PATH, "-s", DEVICE, "exec-out", "uiautomator", "dump", "/dev/tty"],
+        capture_output=True, timeout=10
+    ).stdout
+    idx = raw.find(b'<')
+    end = raw.rfind(b'</hierarchy>')
+    return ET.fromstring(raw[idx:end + len(b'</hierarchy>')])
 
 def _walk_xml(node: ET.Element, depth: int = 0, max_depth: int = 5) -> list:
     """Walk XML tree and produce text representation."""